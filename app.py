@@ -1,8 +1,10 @@
 #!/usr/bin/env python3.11
 
-import os, logging, requests
-from flask import Flask, jsonify, request, render_template_string
-from google.protobuf.json_format import MessageToDict
+import os, atexit, gzip, logging, logging.handlers, queue, orjson, requests, threading, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from typing import Final, Optional
+from flask import Flask, Response, request
 
 from node_controller.controller.controller import Controller
 from node_controller.gateway.protos import celaut_pb2
@@ -20,20 +22,26 @@ if False: # In that case, we automatically consider that the app is running in d
     CONFIG_FILE = "__config__"
 # End of development mode
 
-env_vars = {}
 with open(os.path.join(DIR, ".dependencies")) as f:
-    for line in f:
-        key, value = line.strip().split("=")
-        env_vars[key] = value
-
-TINY_SERVICE = env_vars.get("TINY", None)  # From .dependencies TINY
-HEAVY_SERVICE = env_vars.get("HEAVY", None)
-PING_SERVICE = env_vars.get("PING", None)
-
+    env_vars = dict(line.strip().split("=", 1) for line in f if "=" in line)
+
+TINY_SERVICE: Final[Optional[str]] = env_vars.get("TINY", None)  # From .dependencies TINY
+HEAVY_SERVICE: Final[Optional[str]] = env_vars.get("HEAVY", None)
+PING_SERVICE: Final[Optional[str]] = env_vars.get("PING", None)
+
+# Log records are queued by the request handlers and written to app.log by a background listener,
+# so the request path never blocks on disk writes.
+log_file_handler = logging.FileHandler('app.log')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush pending records on exit.
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # The full format is applied by log_file_handler.
 logging.basicConfig(
-    filename='app.log',
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    level=logging.INFO,
+    handlers=[log_queue_handler]
 )
 
 # Create a new Flask app
@@ -49,6 +57,20 @@ resources = {
     "mem_limit": mem_limit
 }
 gas_amount = 0
+resources_revision = 0  # Bumped on every resources update, used as the ETag of the resource endpoints.
+state_lock = threading.Lock()  # Guards resources, gas_amount, their formatted values and revision.
+
+# Gas in scientific notation.
+def format_gas(amount):
+    return "{:.2e}".format(amount)
+
+# Memory in whole MB, avoiding long zero sequences.
+def format_memory(mem_bytes):
+    return str((mem_bytes or 0) >> 20)
+
+# The formatted values only change with the resources, so they are computed on update instead of on every poll.
+gas_formatted = format_gas(gas_amount)
+memory_formatted = format_memory(resources['mem_limit'])
 
 tiny_service = controller.add_service(service_hash=TINY_SERVICE)  # Generates the instance obj on the library. It will start instances, stop and check if they are alive in background.
 
@@ -61,7 +83,19 @@ heavy_service = controller.add_service(
 
 ping_service = controller.add_service(service_hash=PING_SERVICE)
 
-services = []
+# services holds two parallel lists, the IP:port of each service and its last result.
+# It is copy-on-write: writers build new lists and rebind the pair under services_lock,
+# readers just take the current binding without locking.
+services = ([], [])
+services_revision = 0  # Bumped on every services update, used as the ETag of /services.
+services_lock = threading.Lock()
+
+# Shared HTTP session so concurrent calls to the services reuse pooled connections.
+# (connect, read) in seconds: unreachable instances fail fast, slow ones (heavy computes, ping calls out) can still answer.
+SERVICE_REQUEST_TIMEOUT = (2.0, 30.0)
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0))
+
 logging.info('Gateway main directory: %s', node_url)
 
 # HTML template for the page
@@ -135,15 +169,12 @@ HTML_TEMPLATE = """
 
         async function updateDisplay() {
             try {
-                const memoryResponse = await fetch('/memory_usage');
-                const memoryData = await memoryResponse.json();
-                document.getElementById('memoryDisplay').innerText = 'Memory Used: ' + memoryData.memory_used + ' MB';
-                
-                const gasResponse = await fetch('/current_gas');
-                const gasData = await gasResponse.json();
-                document.getElementById('gasDisplay').innerText = 'Gas Amount: ' + gasData.gas_amount;
+                const response = await fetch('/status');
+                const statusData = await response.json();
+                document.getElementById('memoryDisplay').innerText = 'Memory Used: ' + statusData.memory_used + ' MB';
+                document.getElementById('gasDisplay').innerText = 'Gas Amount: ' + statusData.gas_amount;
 
-                return memoryData.memory_used;
+                return statusData.memory_used;
             } catch (error) {
                 console.error('Error updating display:', error);
             }
@@ -158,7 +189,7 @@ HTML_TEMPLATE = """
         async function sendAdjustment() {
             try {
                 const currentMemory = await updateDisplay();
-                const newMemoryLimit = parseFloat(currentMemory) + memoryAdjustment;
+                const newMemoryLimit = parseInt(currentMemory, 10) + memoryAdjustment;
 
                 const response = await fetch('/modify_max_memory', {
                     method: 'POST',
@@ -289,11 +320,39 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# The template has no variables, so the page is encoded (and compressed) once and served as is.
+HOME_HTML = HTML_TEMPLATE.encode()
+HOME_HTML_GZIP = gzip.compress(HOME_HTML)
+
+# Build a JSON response encoded with orjson.
+def ojson(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# The revisions restart at 0 with the process, so ETags also carry a per-process token.
+BOOT_ID = uuid.uuid4().hex
+
+# Answer with 304 Not Modified when the client already has the current revision, otherwise build the response.
+def conditional_response(revision, build_response):
+    etag = f'W/"{BOOT_ID}-{revision}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = Response(status=304)
+    else:
+        response = build_response()
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'  # Let the browser revalidate every poll.
+    return response
+
 # Define the home route to serve the HTML page
 @app.route('/')
 def home():
-    logging.info('Serving the home page.')
-    return render_template_string(HTML_TEMPLATE)
+    logging.debug('Serving the home page.')
+    if request.accept_encodings['gzip']:
+        response = Response(HOME_HTML_GZIP, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(HOME_HTML, mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    return response
 
 # Endpoint to modify memory limit
 @app.route('/modify_max_memory', methods=['POST'])
@@ -303,31 +362,54 @@ def modify_mem_limit():
         logging.info('Memory limit updating to %s', max_mem_limit)
         if max_mem_limit is None:
             logging.warning('Received request without max_mem_limit.')
-            return jsonify({"error": "Missing 'max_mem_limit' in request body"}), 400
+            return ojson({"error": "Missing 'max_mem_limit' in request body"}, 400)
         
-        max_mem_limit = int(max_mem_limit * (1024 * 1024))
+        max_mem_limit = int(max_mem_limit) << 20  # MB to bytes.
 
         _resources, _gas_amount = controller.modify_resources(
             resources={'max': max_mem_limit, 'min': 0}
         )
+
+        global resources, gas_amount, gas_formatted, memory_formatted, resources_revision
+        with state_lock:
+            resources = {
+                "mem_limit": int(_resources.mem_limit)
+            }
+            gas_amount = int(_gas_amount)
+            gas_formatted = format_gas(gas_amount)
+            memory_formatted = format_memory(resources['mem_limit'])
+            resources_revision += 1
         
-        _resources = MessageToDict(_resources)
-        global resources, gas_amount
-        resources = {
-            "mem_limit": int(_resources["memLimit"])
-        }
-        gas_amount = int(_gas_amount)
-        
-        logging.info('Memory limit updated to %s', resources['mem_limit'])
-        return jsonify({"status": "Memory limit updated"})
+        logging.info('Memory limit updated to %s', int(_resources.mem_limit))
+        return ojson({"status": "Memory limit updated"})
     except Exception as e:
         logging.error('Error while modifying memory limit: %s', str(e))
-        return jsonify({"error": str(e)}), 500
+        return ojson({"error": str(e)}, 500)
 
 # Endpoint to retrieve services data
 @app.route('/services', methods=['GET'])
 def get_services():
-    return jsonify([{"ip_port": service[0], "result": service[1]} for service in services])
+    revision = services_revision  # Read before the data, so a newer ETag is never paired with stale data.
+    service_ips, service_results = services
+
+    # Encode the table one service at a time instead of building the whole document in memory.
+    def stream_json_array():
+        yield b"["
+        for idx, (ip_port, result) in enumerate(zip(service_ips, service_results)):
+            if idx:
+                yield b","
+            yield orjson.dumps({"ip_port": ip_port, "result": result})
+        yield b"]"
+
+    return conditional_response(revision, lambda: Response(stream_json_array(), mimetype='application/json'))
+
+# Append a new service, with no result yet, to the services table.
+def add_service_row(service_uri):
+    global services, services_revision
+    with services_lock:
+        service_ips, service_results = services
+        services = (service_ips + [service_uri], service_results + ["--"])
+        services_revision += 1
 
 # Endpoint to generate a new service
 @app.route('/generate_service', methods=['POST'])
@@ -336,12 +418,12 @@ def generate_service():
         service_uri = tiny_service.get_instance(max_attempts=1).uri
 
         new_service = (service_uri, "--")
-        services.append(new_service)
+        add_service_row(service_uri)
         logging.info('Generated new service: %s', new_service)
-        return jsonify({"status": "Service generated", "service": new_service})
+        return ojson({"status": "Service generated", "service": new_service})
     except Exception as e:
         logging.error('Error while generating service: %s', str(e))
-        return jsonify({"error": str(e)}), 500
+        return ojson({"error": str(e)}, 500)
     
 # Endpoint to generate a new service
 @app.route('/generate_heavy_service', methods=['POST'])
@@ -350,12 +432,12 @@ def generate_heavy_service():
         service_uri = heavy_service.get_instance(max_attempts=1).uri
 
         new_service = (service_uri, "--")
-        services.append(new_service)
+        add_service_row(service_uri)
         logging.info('Generated new service: %s', new_service)
-        return jsonify({"status": "Service generated", "service": new_service})
+        return ojson({"status": "Service generated", "service": new_service})
     except Exception as e:
         logging.error('Error while generating service: %s', str(e))
-        return jsonify({"error": str(e)}), 500
+        return ojson({"error": str(e)}, 500)
 
 # Endpoint to generate a new service
 @app.route('/generate_ping_service', methods=['POST'])
@@ -364,49 +446,67 @@ def generate_ping_service():
         service_uri = ping_service.get_instance(max_attempts=1).uri
 
         new_service = (service_uri, "--")
-        services.append(new_service)
+        add_service_row(service_uri)
         logging.info('Generated new service: %s', new_service)
-        return jsonify({"status": "Service generated", "service": new_service})
+        return ojson({"status": "Service generated", "service": new_service})
     except Exception as e:
         logging.error('Error while generating service: %s', str(e))
-        return jsonify({"error": str(e)}), 500
+        return ojson({"error": str(e)}, 500)
     
 @app.route('/use_services', methods=['POST'])
 def use_services():
+    def call_service(ip_port):
+        try:
+            response = http_session.get(f"http://{ip_port}", timeout=SERVICE_REQUEST_TIMEOUT)
+            return response.text  # Extract the text from the response.
+        except requests.exceptions.RequestException as e:
+            logging.error('Error contacting service at %s: %s', ip_port, str(e))
+            return 'Error'
+
+    global services, services_revision
     try:
-        for idx, service in enumerate(services):
-            ip_port = service[0]
-            try:
-                response = requests.get(f"http://{ip_port}")
-                result = response.text  # Extract the text from the response.
-            except requests.exceptions.RequestException as e:
-                logging.error('Error contacting service at %s: %s', ip_port, str(e))
-                result = 'Error'
-
-            # Update the result in the services list.
-            services[idx] = (ip_port, result)
-            logging.info('Updated service result for %s: %s', ip_port, result)
-        
-        return jsonify({"status": "Services used successfully", "services": services})
+        service_ips = services[0]
+        if not service_ips:
+            return ojson({"status": "Services used successfully", "services": []})
+
+        # Contact every service concurrently, the calls are independent from each other.
+        results = []
+        with ThreadPoolExecutor(max_workers=min(32, len(service_ips))) as executor:
+            futures = {
+                executor.submit(call_service, ip_port): idx
+                for idx, ip_port in enumerate(service_ips)
+            }
+            for future in as_completed(futures):
+                results.append((futures[future], future.result()))
+
+        # Publish the results in a single pass, keeping any service generated in the meantime.
+        with services_lock:
+            service_ips, service_results = services
+            service_results = list(service_results)
+            for idx, result in results:
+                service_results[idx] = result
+            services = (service_ips, service_results)
+            services_revision += 1
+        for idx, result in results:
+            logging.info('Updated service result for %s: %s', service_ips[idx], result)
+
+        return ojson({"status": "Services used successfully", "services": list(zip(service_ips, service_results))})
     except Exception as e:
         logging.error('Error while using services: %s', str(e))
-        return jsonify({"error": str(e)}), 500
-
-# Endpoint to view the current gas amount in scientific notation
-@app.route('/current_gas', methods=['GET'])
-def current_gas():
-    gas_scientific = "{:.2e}".format(gas_amount)
-    logging.info('Current gas amount: %s', gas_scientific)
-    return jsonify({"gas_amount": gas_scientific})
-
-# Endpoint to view memory usage (in MB, avoiding long zero sequences)
-@app.route('/memory_usage', methods=['GET'])
-def memory_usage():
-    memory_used_bytes = resources.get('mem_limit', 0)
-    memory_used_mb = memory_used_bytes / (1024 * 1024) if memory_used_bytes else 0
-    memory_used_formatted = "{:.2f}".format(memory_used_mb)
-    logging.info('Current memory usage: %s MB', memory_used_formatted)
-    return jsonify({"memory_used": memory_used_formatted})
+        return ojson({"error": str(e)}, 500)
+
+# Endpoint to view the current gas amount (in scientific notation) and memory usage (in MB, avoiding long zero sequences)
+@app.route('/status', methods=['GET'])
+def status():
+    with state_lock:
+        gas_scientific = gas_formatted
+        memory_used_formatted = memory_formatted
+        revision = resources_revision
+    logging.debug('Current gas amount: %s, memory usage: %s MB', gas_scientific, memory_used_formatted)
+    return conditional_response(revision, lambda: ojson({
+        "memory_used": memory_used_formatted,
+        "gas_amount": gas_scientific
+    }))
 
 # Run the app on the local server
 if __name__ == '__main__':